@@ -1,122 +1,391 @@
 import errno
 import socket
 import sys
+import threading
+import time
 
+# Receivers read this many bytes per datagram (see UDPConnection.receive_message)
+MAX_MESSAGE_SIZE = 4096
+
+
+def listen(rr_table, udp_connection=None, stop=None, subscriber_timeout=15, clock=time.monotonic, show_table=True):
+    # udp_connection can be a localserver.LoopbackConnection to run without real sockets
+    # stop is an optional threading.Event, the server shuts down soon after it is set
+    # show_table=False skips printing the RR table after every query (benchmarks)
+    udp_connection = udp_connection if udp_connection is not None else UDPConnection(timeout=1)
+
+    # Local servers that asked to be told about record changes, address -> when they last did
+    # local servers renew with a serial check every few seconds, the ones that stop renewing for
+    # subscriber_timeout seconds are dropped
+    subscribers = {}
+
+    def send_transfer(flag, serial, records, address):
+        # Snapshot or delta, sent in as many parts as it needs
+        for part in split_transfer(flag, serial, records):
+            try:
+                udp_connection.send_message(part, address)
+            except OSError as e:
+                print(f"Could not send to {address}: {e}")
+                return
+
+    def push_changes(serial, changes):
+        # Called by rr_table after every change, send the delta to every subscribed local server
+        now = clock()
+        for subscriber_address, renewed_at in list(subscribers.items()):
+            if now - renewed_at > subscriber_timeout:
+                print(f"Dropping subscriber {subscriber_address}, it stopped renewing.")
+                subscribers.pop(subscriber_address, None)
+                continue
+            send_transfer("0011", serial, changes, subscriber_address)
+
+    rr_table.listeners.append(push_changes)
 
-def listen(rr_table):
-    udp_connection = UDPConnection(timeout=1)
     try:
-        while True:
-            # Wait for query
-            query, local_address = udp_connection.receive_message()
-            query_data = deserialize(query)
-            print(f"Query from {local_address}: {query_data}")
-            # Check RR table for record
-            name = query["question"]["name"]
-            query_type = query["question"]["type"]
-            record = rr_table.get_record(name, query_type)
-            # If not found, add "Record not found" in the DNS response
-            if record:
-                response = {
-                    "transaction_id": query["transaction_id"],
-                    "flag": "0001",
-                    "question": query["question"],
-                    "answer": {
-                        "name": record["name"],
-                        "type": record["type"],
-                        "ttl": record["ttl"],
-                        "result": record["result"]
-                    }
+        udp_connection.bind(("127.0.0.1", 22000))
+
+        while stop is None or not stop.is_set():
+            # Wait for query, waking up on the socket timeout to check stop
+            message, local_address = udp_connection.receive_message(wait_forever=False)
+            if message is None:
+                continue
+            # Only the header and questions are decoded, queries carry no answers
+            try:
+                query = Message(message)
+            except ValueError as e:
+                print(f"Dropping malformed message from {local_address}: {e}")
+                continue
+            print(f"Query from {local_address}: {query}")
+
+            # Subscribe: remember the local server and send it the whole zone to start from
+            if query.flag == "0010":
+                subscribers[local_address] = clock()
+                serial, records = rr_table.snapshot()
+                send_transfer("0010", serial, records, local_address)
+                continue
+
+            # Serial check: a subscribed local server asks for the current serial, so it notices a lost
+            # delta without waiting for the next one. Also renews the subscription after a restart
+            if query.flag == "0101":
+                subscribers[local_address] = clock()
+                serial_response = {
+                    "transaction_id": rr_table.serial,
+                    "flag": "0101",
+                    "questions": [],
+                    "answers": []
                 }
-            # Else, return record in DNS response
-            else:
-                response = {
-                    "transaction_id": query["transaction_id"],
-                    "flag": "0001",
-                    "question": query["question"],
-                    "answer": {
-                        "name": name,
-                        "type": query_type,
+                udp_connection.send_message(serialize(serial_response), local_address)
+                continue
+
+            # Update: change records (ttl 0 removes a record), only accepted from this machine
+            # rr_table pushes the change to subscribers through push_changes
+            if query.flag == "0100":
+                if local_address[0] != "127.0.0.1":
+                    continue
+                try:
+                    changes = query.answers
+                except ValueError as e:
+                    print(f"Dropping malformed update from {local_address}: {e}")
+                    continue
+                rr_table.apply_changes(changes)
+                udp_connection.send_message(serialize_response(query, query.answers), local_address)
+                if show_table:
+                    rr_table.display_table()
+                continue
+
+            # Check RR table for every question, a question can match several records
+            # records already have the name, type, ttl and result keys an answer needs
+            answers = []
+            for question in query.questions:
+                records = rr_table.lookup(question.name, question.type_code)
+                # Return every matching record in the DNS response
+                answers += records
+                # If not found, add "Record not found" for that question
+                if not records:
+                    answers.append({
+                        "name": question.name,
+                        "type": question.type,
                         "ttl": 0,
                         "result": "Record not found"
-                    }
-                }
+                    })
 
             # The format of the DNS query and response is in the project description
-            udp_connection.send_message(serialize(response), local_address)
+            udp_connection.send_message(serialize_response(query, answers), local_address)
             # Display RR table
-            rr_table.display_table()
-            pass
+            if show_table:
+                rr_table.display_table()
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
+        rr_table.listeners.remove(push_changes)
         # Close UDP socket
         udp_connection.close()
-        pass
 
 
 def main():
     # Add initial records
     # These can be found in the test cases diagram
     rr_table = RRTable()
-    rr_table.add_record()
-    amazone_dns_address = ("127.0.0.1", 22000)
-    # Bind address to UDP socket
-    udp_connection = UDPConnection(timeout=1)
-    udp_connection.bind(amazone_dns_address)
-    listen()
+
+    initial_records = [
+        ("shop.amazone.com", "A", "3.33.147.88", 60, 1),
+        ("cloud.amazone.com", "A", "15.197.140.28", 60, 1),
+        ("amazone.com", "NS", "dns.amazone.com", 60, 1),
+        ("dns.amazone.com", "A", "127.0.0.1", 60, 1)
+    ]
+
+    for record in initial_records:
+        rr_table.add_record(*record)
+
+    # Bind address to UDP socket (127.0.0.1:22000) and serve queries
+    # to test pushed updates: run localserver.py and this in two terminals,
+    # then run test_update() from a third one and watch the local server's table change
+    listen(rr_table)
+
+
+def test_update():
+    admin = UDPConnection()
+    message = {
+        "transaction_id": 1,
+        "flag": "0100",
+        "questions": [],
+        "answers": [
+            {"name": "shop.amazone.com", "type": "A", "ttl": 0, "result": "3.33.147.88"},
+            {"name": "shop.amazone.com", "type": "A", "ttl": 3600, "result": "3.33.147.89"}
+        ]
+    }
+    admin.send_message(serialize(message), ("127.0.0.1", 22000))
+    response, _ = admin.receive_message()
+    print("Response from server:", response)
 
 
 def serialize(message: dict) -> str:
-    # converting from DNS format (dict) to str 
+    # converting from DNS format (dict) to str
     # uses provided DNStypes class
-    qname = message["question"]["name"]
-    qtype = DNSTypes.get_type_code(message["question"]["type"])
-    aname = message["answer"].get("name", "")
-    atype = DNSTypes.get_type_code(message["answer"].get("type", ""))
-    ttl = message["answer"].get("ttl", "")
-    result = message["answer"].get("result", "")
-    return f"{message['transaction_id']},{message['flag']},{qname},{qtype},{aname},{atype},{ttl},{result}"
-
-
-def deserialize(data: str) -> dict:
-    # converting from string back to DNS dict
-    fields = data.split(',')
-    return {
-        "transaction_id": int(fields[0]),
-        "flag": fields[1],
-        "question": {
-            "name": fields[2],
-            "type": DNSTypes.get_type_name(int(fields[3]))
-        },
-        "answer": {
-            "name": fields[4],
-            "type": DNSTypes.get_type_name(int(fields[5])) if fields[5] else "",
-            "ttl": int(fields[6]) if fields[6] else None,
-            "result": fields[7] if len(fields) > 7 else ""
-        }
-    }
+    # header carries the question and answer counts so one message can hold several of each:
+    # transaction_id,flag,qdcount,ancount,(qname,qtype)*,(aname,atype,ttl,result)*
+    questions = message.get("questions", [])
+    answers = message.get("answers", [])
+    fields = [str(message["transaction_id"]), message["flag"], str(len(questions)), str(len(answers))]
+    for question in questions:
+        fields += [question["name"], str(DNSTypes.get_type_code(question["type"]) or 0)]
+    for answer in answers:
+        fields += [answer["name"], str(DNSTypes.get_type_code(answer["type"]) or 0), str(answer["ttl"]), answer["result"]]
+    return ",".join(fields)
+
+
+def split_transfer(flag: str, serial: int, records: list) -> list:
+    """
+    Serializes a snapshot (flag 0010) or delta (flag 0011) into messages of at most MAX_MESSAGE_SIZE bytes.
+
+    Every part carries the serial as its transaction id and a single question named
+    "index/count" (type code 0) so the receiver can put the parts back together.
+
+    Examples:
+    >>> records = [{"name": f"host{i}.amazone.com", "type": "A", "ttl": 60, "result": "10.0.0.1"} for i in range(200)]
+    >>> parts = split_transfer("0010", 7, records)
+    >>> len(parts), max(len(part.encode()) for part in parts) <= MAX_MESSAGE_SIZE
+    (2, True)
+    >>> parts[1][:22]
+    '7,0010,1,79,1/2,0,host'
+    """
+    # Room left for the header and the part question, whatever the counts are
+    budget = MAX_MESSAGE_SIZE - 64
+    chunks = [[]]
+    size = 0
+    for record in records:
+        record_size = len(f"{record['name']},{DNSTypes.get_type_code(record['type']) or 0},{record['ttl']},{record['result']}") + 1
+        if chunks[-1] and size + record_size > budget:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(record)
+        size += record_size
+
+    return [
+        serialize({
+            "transaction_id": serial,
+            "flag": flag,
+            "questions": [{"name": f"{index}/{len(chunks)}", "type": None}],
+            "answers": chunk
+        })
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def serialize_response(query, answers) -> str:
+    # Response to a parsed query (Message), the question section is sent back as it was received
+    fields = [str(query.transaction_id), "0001", str(len(query.questions)), str(len(answers))]
+    if query.questions:
+        fields.append(query.question_section)
+    for answer in answers:
+        fields += [answer["name"], str(DNSTypes.get_type_code(answer["type"]) or 0), str(answer["ttl"]), answer["result"]]
+    return ",".join(fields)
+
+
+class Question:
+    """A question of a Message, with its type as both the DNSTypes code and name."""
+
+    __slots__ = ("name", "type_code", "type")
+
+    def __init__(self, name: str, type_code: int):
+        self.name = name
+        self.type_code = type_code
+        self.type = DNSTypes.code_to_name.get(type_code)
+
+    def __repr__(self):
+        return f"Question({self.name!r}, {self.type!r})"
+
+
+class Message:
+    """
+    A DNS message parsed from the format produced by serialize.
+
+    Only the header and questions are parsed when the message is created. Answers are
+    decoded on first access, incoming queries never look at them.
+
+    Examples:
+    >>> message = Message("7,0000,2,0,shop.amazone.com,8,shop.amazone.com,4")
+    >>> message.transaction_id, message.flag, message.questions
+    (7, '0000', [Question('shop.amazone.com', 'A'), Question('shop.amazone.com', 'AAAA')])
+    >>> message.questions[1].type_code == DNSTypes.get_type_code('AAAA')
+    True
+    >>> Message("7,0001,0,1,shop.amazone.com,8,60,3.33.147.88").answers
+    [{'name': 'shop.amazone.com', 'type': 'A', 'ttl': 60, 'result': '3.33.147.88'}]
+    >>> Message("garbage")
+    Traceback (most recent call last):
+    ...
+    ValueError: Malformed message header: 'garbage'
+    """
+
+    __slots__ = ("transaction_id", "flag", "questions", "question_section", "_answer_count", "_answer_section", "_answers")
+
+    def __init__(self, data: str):
+        # Raises ValueError if data is not a well formed message
+        header = data.split(',', 4)
+        if len(header) < 4:
+            raise ValueError(f"Malformed message header: {data[:40]!r}")
+        self.transaction_id = int(header[0])
+        self.flag = header[1]
+        question_count = int(header[2])
+        self._answer_count = int(header[3])
+        if question_count < 0 or self._answer_count < 0:
+            raise ValueError(f"Malformed message counts: {data[:40]!r}")
+        body = header[4] if len(header) > 4 else ""
+        self._answers = None
+
+        if not question_count:
+            self.questions = []
+            self.question_section = ""
+            self._answer_section = body
+            return
+
+        # Split off the questions only, the answers stay one unparsed string
+        fields = body.split(',', 2 * question_count)
+        if len(fields) < 2 * question_count + (1 if self._answer_count else 0):
+            raise ValueError(f"Message shorter than its question count: {data[:40]!r}")
+        if self._answer_count:
+            self._answer_section = fields.pop()
+            self.question_section = body[:len(body) - len(self._answer_section) - 1]
+        else:
+            self._answer_section = ""
+            self.question_section = body
+        self.questions = list(map(Question, fields[::2], map(int, fields[1::2])))
+
+    @property
+    def answers(self):
+        """The answers as dicts, raises ValueError if the answer section does not match its count"""
+        if self._answers is None:
+            fields = self._answer_section.split(',')
+            if self._answer_count and len(fields) != 4 * self._answer_count:
+                raise ValueError(f"Answer section does not hold {self._answer_count} answers")
+            self._answers = [
+                {
+                    "name": fields[i],
+                    "type": DNSTypes.get_type_name(int(fields[i + 1])),
+                    "ttl": int(fields[i + 2]) if fields[i + 2] not in ("", "None") else None,
+                    "result": fields[i + 3]
+                }
+                for i in range(0, 4 * self._answer_count, 4)
+            ]
+        return self._answers
+
+    def __repr__(self):
+        return f"Message({self.transaction_id}, {self.flag!r}, {self.questions})"
 
 
 class RRTable:
     def __init__(self):
         self.records = []
         self.record_number = 0
+        self.lock = threading.Lock()
+        # (name, DNSTypes code) -> records, so queries find records without scanning the table
+        self.index = {}
+
+        # Incremented on every change, sent with each pushed delta so local servers can spot a missed one
+        self.serial = 0
+        # Called with (serial, changes) after the records change
+        self.listeners = []
 
     def add_record(self, name, type, result, ttl, static):
         with self.lock:
-            self.record_number += 1
+            self.__set_record(name, type, result, ttl, static)
+            self.serial += 1
+            serial = self.serial
 
-            record = {
-                "record_number": self.record_number,
-                "name": name,
-                "type": type,
-                "result": result,
-                "ttl": ttl,
-                "static": static
-            }
+        self.__notify_listeners(serial, [{"name": name, "type": type, "ttl": ttl, "result": result}])
 
-            self.records.append(record)
+    def apply_changes(self, changes):
+        # Each change replaces the record with the same name, type and result, ttl 0 removes it
+        with self.lock:
+            for change in changes:
+                if change["ttl"] != 0:
+                    self.__set_record(change["name"], change["type"], change["result"], change["ttl"], 1)
+                    continue
+                key = (change["name"], DNSTypes.get_type_code(change["type"]))
+                for record in [record for record in self.index.get(key, []) if record["result"] == change["result"]]:
+                    self.records.remove(record)
+                    self.index[key].remove(record)
+
+            # Update record numbers
+            for i, record in enumerate(self.records, start = 1):
+                record['record_number'] = i
+            self.record_number = len(self.records)
+
+            self.serial += 1
+            serial = self.serial
+
+        self.__notify_listeners(serial, changes)
+
+    def __set_record(self, name, type, result, ttl, static):
+        # This method is only called within a locked context
+        # a record with the same name, type and result is updated instead of stored twice
+        key = (name, DNSTypes.get_type_code(type))
+        for record in self.index.get(key, []):
+            if record["result"] == result:
+                record["ttl"] = ttl
+                record["static"] = static
+                return
+
+        self.record_number += 1
+
+        record = {
+            "record_number": self.record_number,
+            "name": name,
+            "type": type,
+            "result": result,
+            "ttl": ttl,
+            "static": static
+        }
+
+        self.records.append(record)
+        self.index.setdefault(key, []).append(record)
+
+    def snapshot(self):
+        # The current serial and every record, sent to a local server when it subscribes
+        with self.lock:
+            return self.serial, [
+                {"name": record["name"], "type": record["type"], "ttl": record["ttl"], "result": record["result"]}
+                for record in self.records
+            ]
 
     def get_record(self, name, type):
         with self.lock:
@@ -124,6 +393,16 @@ class RRTable:
                 if record["name"] == name and record["type"] == type:
                     return record
 
+    def get_records(self, name, type):
+        # Every record matching name and type, a name can have several A records
+        return list(self.lookup(name, DNSTypes.get_type_code(type)))
+
+    def lookup(self, name, type_code):
+        # Records for name and a DNSTypes code straight from the index, used on the query path
+        # the returned list belongs to the table, do not modify it
+        with self.lock:
+            return self.index.get((name, type_code), [])
+
     def display_table(self):
         # Display the table in the following format (include the column names):
         print("record_no,name,type,result,ttl,static")
@@ -133,6 +412,11 @@ class RRTable:
         # record_number,name,type,result,ttl,static
         pass
 
+    def __notify_listeners(self, serial, changes):
+        # Called outside the lock so listeners can read the table
+        for listener in self.listeners:
+            listener(serial, changes)
+
 
 class DNSTypes:
     """
@@ -178,10 +462,13 @@ class UDPConnection:
         """Sends a message to the specified address."""
         self.socket.sendto(message.encode(), address)
 
-    def receive_message(self):
+    def receive_message(self, wait_forever: bool = True):
         """
         Receives a message from the socket.
 
+        Args:
+            wait_forever: Keep waiting across socket timeouts. If False, return (None, None) on timeout.
+
         Returns:
             tuple (data, address): The received message and the address it came from.
 
@@ -192,7 +479,13 @@ class UDPConnection:
             try:
                 data, address = self.socket.recvfrom(4096)
                 return data.decode(), address
+            except UnicodeDecodeError:
+                # Not a message of ours, drop it like any other malformed datagram
+                print(f"Dropping datagram from {address} that is not text.")
+                continue
             except socket.timeout:
+                if not wait_forever:
+                    return None, None
                 continue
             except OSError as e:
                 if e.errno == errno.ECONNRESET:
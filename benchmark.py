@@ -0,0 +1,333 @@
+"""
+Performance benchmarks for the DNS servers, run entirely in this process.
+
+RRTables run on a SimulatedClock with the background expiry thread off, and the servers talk
+over a LoopbackNetwork instead of UDP ports 21000/22000, so runs are repeatable and quick.
+
+Each timing run of a case is paired with a run of a fixed pure Python loop right before it, and
+baselines are compared on the time relative to that loop, so a machine that is slower for a
+while (other load, CPU throttling) does not show up as a regression.
+
+Usage:
+    python benchmark.py                  # run and compare against the saved baseline
+    python benchmark.py --save           # run 3 times and save the median as the new baseline
+    python benchmark.py --threshold 1.5  # flag cases more than 1.5x slower than the baseline
+
+resolution_cached_logged is also held to the threshold against resolution_cached of the same run,
+so a query log that slows resolution down is flagged even when the baseline was saved with it.
+Exits with status 1 if any case is still past the threshold after being run again --retries times.
+benchmark_baseline.json is checked in, save a new one when the code gets faster on purpose.
+Correctness of the servers is covered by test_dns.py, the resolution cases also check every answer.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import timeit
+
+import amazone
+import localserver
+from localserver import LoopbackConnection, LoopbackNetwork, QueryLog, RateLimiter, RRTable, SimulatedClock
+
+RECORD_COUNT = 1000
+QUERY_COUNT = 2000
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def make_names(count):
+    return [f"host{i}.amazone.com" for i in range(count)]
+
+
+def time_per_call(function, number, repeat=10, calls=1):
+    # Best of repeat runs, as (microseconds per call, calibration loops per call)
+    # calls is how many calls one call of function stands for
+    times = []
+    relative_times = []
+    for _ in range(repeat):
+        calibration_time = min(timeit.repeat(calibration, number=5, repeat=3)) / 5
+        time = timeit.timeit(function, number=number) / number / calls
+        times.append(time)
+        relative_times.append(time / calibration_time)
+    return min(times) * 1e6, min(relative_times)
+
+
+def calibration():
+    # Fixed amount of plain interpreter work, the unit relative times are measured in
+    total = 0
+    for i in range(1000):
+        total += len(str(i))
+    return total
+
+
+def bench_lookup():
+    rr_table = RRTable(clock=SimulatedClock(), expire_in_background=False)
+    names = make_names(RECORD_COUNT)
+    for name in names:
+        rr_table.add_record(name, "A", "10.0.0.1", 60, 0)
+    # Average over hits spread across the whole table
+    lookups = iter(names * 1000)
+    return time_per_call(lambda: rr_table.get_records(next(lookups), "A"), number=RECORD_COUNT)
+
+
+def bench_expiry():
+    # One expiry tick over a full table where nothing expires yet
+    clock = SimulatedClock()
+    rr_table = RRTable(clock=clock, expire_in_background=False)
+    for name in make_names(RECORD_COUNT):
+        rr_table.add_record(name, "A", "10.0.0.1", 10 ** 9, 0)
+
+    def tick():
+        clock.advance(1)
+        rr_table.expire()
+
+    return time_per_call(tick, number=100)
+
+
+def sample_response():
+    return {
+        "transaction_id": 1,
+        "flag": "0001",
+        "questions": [{"name": "shop.amazone.com", "type": "A"}, {"name": "shop.amazone.com", "type": "AAAA"}],
+        "answers": [
+            {"name": "shop.amazone.com", "type": "A", "ttl": 60, "result": "3.33.147.88"},
+            {"name": "shop.amazone.com", "type": "A", "ttl": 60, "result": "3.33.147.89"},
+            {"name": "shop.amazone.com", "type": "AAAA", "ttl": 0, "result": "Record not found"}
+        ]
+    }
+
+
+def bench_serialize():
+    response = sample_response()
+    return time_per_call(lambda: localserver.serialize(response), number=2000)
+
+
+def bench_deserialize():
+    data = localserver.serialize(sample_response())
+    return time_per_call(lambda: localserver.deserialize(data), number=2000)
+
+
+def bench_message():
+    # Response decode, answers are decoded on first access
+    data = localserver.serialize(sample_response())
+    return time_per_call(lambda: localserver.Message(data).answers, number=2000)
+
+
+def sample_query():
+    # One question for every record type, as the client's ALL query sends
+    return localserver.serialize({
+        "transaction_id": 1,
+        "flag": "0000",
+        "questions": [{"name": "shop.amazone.com", "type": type} for type in localserver.DNSTypes.name_to_code],
+        "answers": []
+    })
+
+
+def bench_query_deserialize():
+    # What the listen loop did with every query before Message: decode everything into dicts
+    data = sample_query()
+
+    def decode():
+        for question in localserver.deserialize(data)["questions"]:
+            question["name"], question["type"]
+
+    return time_per_call(decode, number=2000)
+
+
+def bench_query_message():
+    # The listen loop's query path: header and questions only
+    data = sample_query()
+
+    def decode():
+        for question in localserver.Message(data).questions:
+            question.name, question.type_code
+
+    return time_per_call(decode, number=2000)
+
+
+@contextlib.contextmanager
+def running_servers(record_count, query_log=None):
+    # Both servers as threads on a fresh loopback network, yields the network once the local
+    # server has the authoritative server's snapshot and stops both servers afterwards
+    network = LoopbackNetwork()
+    stop = threading.Event()
+
+    authoritative_table = amazone.RRTable()
+    for name in make_names(record_count):
+        authoritative_table.add_record(name, "A", "10.0.0.1", 60, 1)
+    local_table = RRTable(clock=SimulatedClock(), expire_in_background=False)
+
+    authoritative_connection = LoopbackConnection(network, timeout=0.05)
+    authoritative_connection.bind(("127.0.0.1", 22000))
+    local_connection = LoopbackConnection(network, timeout=0.05)
+    servers = [
+        threading.Thread(target=amazone.listen, args=(authoritative_table, authoritative_connection), kwargs={"stop": stop, "show_table": False}),
+        threading.Thread(
+            target=localserver.listen,
+            args=(local_table,),
+            kwargs={
+                "rate_limiter": RateLimiter(burst=float("inf")),
+                "udp_connection": local_connection,
+                "query_log": query_log,
+                "show_table": False,
+                "stop": stop
+            }
+        )
+    ]
+    for server in servers:
+        server.start()
+
+    try:
+        while len(local_table.records) < record_count:
+            stop.wait(0.01)
+        yield network
+    finally:
+        stop.set()
+        for server in servers:
+            server.join()
+
+
+def resolve_all(network, names, expected_result):
+    # Resolves every name through the local server and checks each answer
+    client = LoopbackConnection(network)
+    for transaction_id, name in enumerate(names):
+        query = {"transaction_id": transaction_id, "flag": "0000", "questions": [{"name": name, "type": "A"}]}
+        client.send_message(localserver.serialize(query), ("127.0.0.1", 21000))
+        message, _ = client.receive_message()
+        response = localserver.Message(message)
+        assert response.transaction_id == transaction_id, f"answer to {response.transaction_id}, expected {transaction_id}"
+        assert [(answer["name"], answer["result"]) for answer in response.answers] == [(name, expected_result)], message
+    client.close()
+
+
+def bench_resolution():
+    # Served from the local server's cache (filled by the subscription snapshot)
+    names = make_names(RECORD_COUNT) * (QUERY_COUNT // RECORD_COUNT)
+    with running_servers(RECORD_COUNT) as network:
+        return time_per_call(lambda: resolve_all(network, names, "10.0.0.1"), number=1, calls=len(names))
+
+
+def bench_resolution_logged():
+    # Same as bench_resolution with a QueryLog attached, should stay within noise of it
+    names = make_names(RECORD_COUNT) * (QUERY_COUNT // RECORD_COUNT)
+    with tempfile.TemporaryDirectory() as log_directory:
+        query_log = QueryLog(os.path.join(log_directory, "queries.log.gz"))
+        # The local server closes the log when it stops
+        with running_servers(RECORD_COUNT, query_log) as network:
+            return time_per_call(lambda: resolve_all(network, names, "10.0.0.1"), number=1, calls=len(names))
+
+
+def bench_resolution_upstream():
+    # Names the authoritative server does not have, every query goes upstream and back
+    names = [f"missing{i}.amazone.com" for i in range(QUERY_COUNT // 4)]
+    with running_servers(RECORD_COUNT) as network:
+        return time_per_call(lambda: resolve_all(network, names, "Record not found"), number=1, calls=len(names))
+
+
+BENCHMARKS = {
+    "rrtable_lookup": bench_lookup,
+    "rrtable_expiry_tick": bench_expiry,
+    "serialize": bench_serialize,
+    "deserialize": bench_deserialize,
+    "message_decode": bench_message,
+    "query_decode_deserialize": bench_query_deserialize,
+    "query_decode_message": bench_query_message,
+    "resolution_cached": bench_resolution,
+    "resolution_cached_logged": bench_resolution_logged,
+    "resolution_upstream": bench_resolution_upstream,
+}
+
+# Cases that must stay within --threshold of another case of the same run, whatever the baseline
+# says: the query log is meant to add no measurable latency to resolution
+SAME_AS = {
+    "resolution_cached_logged": "resolution_cached",
+}
+
+
+def run(names=None):
+    # Returns {case: {"us": microseconds per call, "relative": the same in calibration loops}}
+    results = {}
+    for name in names if names is not None else BENCHMARKS:
+        benchmark = BENCHMARKS[name]
+        # The servers print every query they get, keep that off the terminal
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            microseconds, relative = benchmark()
+        results[name] = {"us": microseconds, "relative": relative}
+        print(f"{name}: {microseconds:.2f} us")
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns the names of the cases more than threshold times slower than the baseline,
+    # or than their SAME_AS case
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["relative"] / baseline[name]["relative"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{name}: {baseline[name]['us']:.2f} -> {result['us']:.2f} us ({ratio:.2f}x relative){flag}")
+        if ratio > threshold:
+            regressions.append(name)
+
+    for name, reference in SAME_AS.items():
+        if name not in results or reference not in results:
+            continue
+        ratio = results[name]["relative"] / results[reference]["relative"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{name}: {ratio:.2f}x {reference}{flag}")
+        if ratio > threshold and name not in regressions:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DNS servers in process.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare against or save to")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio that counts as a regression")
+    parser.add_argument("--rounds", type=int, default=3, help="runs a saved baseline is the median of")
+    parser.add_argument("--retries", type=int, default=2, help="times a regressed case is run again to confirm it")
+    args = parser.parse_args()
+
+    if args.save:
+        # A baseline from a single run may be a lucky one, save the median of a few
+        rounds = [run() for _ in range(args.rounds)]
+        results = {}
+        for name in BENCHMARKS:
+            ordered = sorted((result[name] for result in rounds), key=lambda result: result["relative"])
+            results[name] = ordered[len(ordered) // 2]
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    results = run()
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create one")
+        return
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.threshold)
+    # A short burst of other load can slow one case down, only report what happens again
+    for _ in range(args.retries):
+        if not regressions:
+            break
+        # Cases compared with another one are run again together with it
+        names = regressions + [SAME_AS[name] for name in regressions if SAME_AS.get(name) not in regressions + [None]]
+        print(f"Running {', '.join(names)} again to confirm")
+        for name, result in run(names).items():
+            if result["relative"] < results[name]["relative"]:
+                results[name] = result
+        regressions = compare({name: results[name] for name in names}, baseline, args.threshold)
+    if regressions:
+        print(f"Regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
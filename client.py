@@ -5,28 +5,28 @@ import sys
 import threading
 import time
 
-def handle_request(rr_table, udp_connection, transaction_id, hostname, qtype):
-    # Check RR table for record
-    if rr_table.get_record(hostname, qtype) == None:
-        # If not found, ask the local DNS server, then save the record if valid
+def handle_request(rr_table, udp_connection, transaction_id, hostname, qtypes):
+    # Check RR table for a record of every requested type
+    missing_types = [qtype for qtype in qtypes if rr_table.get_record(hostname, qtype) == None]
+    if missing_types:
+        # If not found, ask the local DNS server for all missing types at once, then save the records if valid
         local_dns_address = ("127.0.0.1", 21000)
 
-        # Request record
+        # Request records
         query = {
             "transaction_id": transaction_id,
             "flag": "0000",
-            "question": {
-                "name": hostname,
-                "type": qtype
-            }
+            "questions": [{"name": hostname, "type": qtype} for qtype in missing_types]
         }
 
         udp_connection.send_message(serialize(query), local_dns_address)
 
-        record = deserialize(udp_connection.receive_message()[0])
+        response = deserialize(udp_connection.receive_message()[0])
 
-        if record["answer"]["result"] != "Record not found":
-            rr_table.add_record(record["answer"]["name"], record["answer"]["type"], record["answer"]["result"], record["answer"]["ttl"], 0)
+        for answer in response["answers"]:
+            # "Server busy" means the local server shed the query, nothing to save
+            if answer["result"] not in ("Record not found", "Server busy"):
+                rr_table.add_record(answer["name"], answer["type"], answer["result"], answer["ttl"], 0)
 
     # Display RR table
     rr_table.display_table()
@@ -51,16 +51,19 @@ def main():
                 break
 
             hostname = input_value
-            qtype = None # determine if user enters a type or not
+            qtypes = None # determine if user enters a type or not
 
             # Extra credit, lets users decide the query type (e.g. A, AAAA, NS, CNAME)
-            # This means input_value will be two values separated by a space
+            # This means input_value will be the hostname followed by one or more types separated by spaces
+            # "ALL" asks for every type in DNSTypes in a single query
             if " " in input_value:
                 hostname = input_value.split()[0]
-                qtype = input_value.split()[1]
+                qtypes = input_value.split()[1:]
+                if "ALL" in qtypes:
+                    qtypes = list(DNSTypes.name_to_code)
 
-            qtype = qtype if qtype is not None else "A"
-            transaction_id = handle_request(rr_table, udp_connection, transaction_id, hostname, qtype)
+            qtypes = qtypes if qtypes is not None else ["A"]
+            transaction_id = handle_request(rr_table, udp_connection, transaction_id, hostname, qtypes)
         
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
@@ -70,44 +73,66 @@ def main():
 
 
 def serialize(message: dict) -> str:
-    # converting from DNS format (dict) to str 
+    # converting from DNS format (dict) to str
     # uses provided DNStypes class
-    qname = message["question"]["name"]
-    qtype = DNSTypes.get_type_code(message["question"]["type"]) or 0
-    aname = message.get("answer", {}).get("name", "") or ""
-    atype = DNSTypes.get_type_code(message.get("answer", {}).get("type", "")) or 0
-    ttl = message.get("answer", {}).get("ttl", "") or None
-    result = message.get("answer", {}).get("result", "") or ""
-    return f"{message['transaction_id']},{message['flag']},{qname},{qtype},{aname},{atype},{ttl},{result}"
+    # header carries the question and answer counts so one message can hold several of each:
+    # transaction_id,flag,qdcount,ancount,(qname,qtype)*,(aname,atype,ttl,result)*
+    questions = message.get("questions", [])
+    answers = message.get("answers", [])
+    fields = [str(message["transaction_id"]), message["flag"], str(len(questions)), str(len(answers))]
+    for question in questions:
+        fields += [question["name"], str(DNSTypes.get_type_code(question["type"]) or 0)]
+    for answer in answers:
+        fields += [answer["name"], str(DNSTypes.get_type_code(answer["type"]) or 0), str(answer["ttl"]), answer["result"]]
+    return ",".join(fields)
 
 def deserialize(data: str) -> dict:
     # converting from string back to DNS dict
     fields = data.split(',')
+    question_count = int(fields[2])
+    answer_count = int(fields[3])
+    index = 4
+
+    questions = []
+    for _ in range(question_count):
+        questions.append({
+            "name": fields[index],
+            "type": DNSTypes.get_type_name(int(fields[index + 1]))
+        })
+        index += 2
+
+    answers = []
+    for _ in range(answer_count):
+        answers.append({
+            "name": fields[index],
+            "type": DNSTypes.get_type_name(int(fields[index + 1])),
+            "ttl": int(fields[index + 2]) if fields[index + 2] not in ("", "None") else None,
+            "result": fields[index + 3]
+        })
+        index += 4
+
     return {
         "transaction_id": int(fields[0]),
         "flag": fields[1],
-        "question": {
-            "name": fields[2],
-            "type": DNSTypes.get_type_name(int(fields[3])) if fields[3] != "" else ""
-        },
-        "answer": {
-            "name": fields[4],
-            "type": DNSTypes.get_type_name(int(fields[5])) if fields[5] not in ("", "None") else "",
-            "ttl": int(fields[6]) if fields[6] and fields[6] != "None" else None,
-            "result": fields[7] if len(fields) > 7 else ""
-        }
+        "questions": questions,
+        "answers": answers
     }
 
 class RRTable:
-    def __init__(self):
+    def __init__(self, clock=time.monotonic, expire_in_background=True):
         self.records = []
-
         self.record_number = 0
 
+        # ttls count down by the clock, pass a SimulatedClock and expire_in_background=False
+        # to move time by hand and call expire() yourself
+        self.clock = clock
+        self.last_expiry = clock()
+
         # Start the background thread
         self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
-        self.thread.start()
+        if expire_in_background:
+            self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
+            self.thread.start()
 
     def add_record(self, name, type, result, ttl, static):
         with self.lock:
@@ -144,21 +169,27 @@ class RRTable:
 
             print()
     
+    def expire(self):
+        # Decrement ttls by the whole seconds passed on the clock since the last call
+        with self.lock:
+            elapsed = int(self.clock() - self.last_expiry)
+            if elapsed > 0:
+                self.last_expiry += elapsed
+                self.__remove_expired_records(elapsed)
+
     def __decrement_ttl(self):
         while True:
-            with self.lock:
-                # Decrement ttl
-                self.__remove_expired_records()
+            self.expire()
             time.sleep(1)
 
-    def __remove_expired_records(self):
+    def __remove_expired_records(self, elapsed):
         # This method is only called within a locked context
         new_records = []
 
         # Remove expired records
         for record in self.records:
             if record['static'] == 0 and record['ttl'] != None:
-                record['ttl'] -= 1
+                record['ttl'] -= elapsed
             
             # if record is still valid or set to static
             if record['static'] == 1 or record['ttl'] == None or record['ttl'] > 0:
@@ -227,6 +258,10 @@ class UDPConnection:
             try:
                 data, address = self.socket.recvfrom(4096)
                 return data.decode(), address
+            except UnicodeDecodeError:
+                # Not a message of ours, drop it like any other malformed datagram
+                print(f"Dropping datagram from {address} that is not text.")
+                continue
             except socket.timeout:
                 continue
             except OSError as e:
@@ -1,85 +1,319 @@
 import errno
+import gzip
+import os
+import queue
 import socket
 import sys
 import threading
 import time
+from collections import OrderedDict, deque
 
 # passing rr_table as a parameter (maybe a better way around this?)
-def listen(rr_table):
-    udp_connection = UDPConnection(timeout=1)
+def listen(rr_table, rate_limiter=None, max_pending=64, max_waiting=1024, upstream_timeout=2, serial_check_interval=5, udp_connection=None, clock=time.monotonic, query_log=None, stop=None, show_table=True):
+    # timeout lets the loop wake up to answer upstream queries that never came back
+    # udp_connection can be a LoopbackConnection to run without real sockets
+    # stop is an optional threading.Event, the server shuts down soon after it is set
+    # show_table=False skips printing the RR table after every query (benchmarks)
+    udp_connection = udp_connection if udp_connection is not None else UDPConnection(timeout=0.5)
+    rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+
+    # Queries sent to the authoritative server, keyed by upstream transaction id (oldest first)
+    # value is (keys, sent_at), keys are the (name, type code) pairs asked in that query
+    pending = OrderedDict()
+    upstream_transaction_id = 0
+
+    # Client queries waiting on upstream answers, keyed by every (name, type code) they still miss,
+    # so clients missing the same name share one upstream query
+    # a waiter is (client_address, query, answers_by_question, remaining_keys, missing_questions, received_at)
+    waiting = {}
+    waiting_count = 0
+
+    def answer_waiters(key, answers):
+        # Give answers (None if the authoritative server has none) to every client waiting on key,
+        # and respond to the ones that are no longer waiting on anything else
+        nonlocal waiting_count
+        for client_address, query, answers_by_question, remaining_keys, missing_questions, received_at in waiting.pop(key, []):
+            if answers:
+                answers_by_question[key] = answers
+            remaining_keys.discard(key)
+            if not remaining_keys:
+                waiting_count -= 1
+                respond(udp_connection, client_address, query, answers_by_question, "Record not found")
+                if query_log is not None:
+                    query_log.record(client_address, query, missing_questions, clock() - received_at)
+
+    # Serial of the last change pushed by the authoritative server, None until its snapshot arrives
+    zone_serial = None
+    # True while a subscribe is waiting for its snapshot, so a burst of deltas after a gap
+    # does not ask for the whole zone once per delta
+    resubscribing = True
+    # Snapshot and delta parts received so far, see collect_transfer
+    transfers = {}
+    # Every serial_check_interval seconds ask the authoritative server for its serial, so a lost
+    # delta (or a lost subscription) is noticed even if no further change is pushed
+    last_serial_check = clock()
 
     try:
         udp_connection.bind(('127.0.0.1', 21000))
         authoritative_address = ('127.0.0.1', 22000)
 
-        while True:
-            # Wait for query
-            query, client_address = udp_connection.receive_message()
-            query_data = deserialize(query)
-            print(f"Query from {client_address}: {query_data}")
-
-            # Check RR table for record
-            name = query_data["question"]["name"]
-            query_type = query_data["question"]["type"]
-            record = rr_table.get_record(name, query_type)
-
-            # If not found, ask the authoritative DNS server of the requested hostname/domain
-            if not record:
-                print(f"Not found locally, querying authoritative server.")
-                udp_connection.send_message(serialize(query_data), authoritative_address)
-                response_data, _ = udp_connection.receive_message()
-                response = deserialize(response_data)
-
-                # Then save the record if valid
-                if response["answer"]["result"] != "Record not found":
-                    rr_table.add_record(
-                        response["answer"]["name"],
-                        response["answer"]["type"],
-                        response["answer"]["result"],
-                        response["answer"]["ttl"],
-                        static=0
-                    )
-            else:
-                response = {
-                    "transaction_id": query_data["transaction_id"],
-                    "flag": "0001",
-                    "question": query_data["question"],
-                    "answer": {
-                        "name": record["name"],
-                        "type": record["type"],
-                        "ttl": record["ttl"],
-                        "result": record["result"]
-                    }
-                }
+        # Subscribe to record changes, the authoritative server answers with a snapshot of its records
+        subscribe(udp_connection, authoritative_address)
+
+        while stop is None or not stop.is_set():
+            # Wait for query (or an upstream response)
+            message, address = udp_connection.receive_message(wait_forever=False)
+
+            # Answer queries the authoritative server did not answer in time
+            now = clock()
+            if now - last_serial_check >= serial_check_interval:
+                last_serial_check = now
+                check_serial(udp_connection, authoritative_address, zone_serial)
+            while pending:
+                oldest_id = next(iter(pending))
+                keys, sent_at = pending[oldest_id]
+                if now - sent_at < upstream_timeout:
+                    break
+                del pending[oldest_id]
+                print(f"Authoritative server did not answer in time, responding to waiting clients.")
+                for name, type_code in keys:
+                    busy = [{"name": name, "type": DNSTypes.get_type_name(type_code), "ttl": 0, "result": "Server busy"}]
+                    answer_waiters((name, type_code), busy)
+
+            if message is None:
+                continue
+
+            # Message from the authoritative server
+            if address == authoritative_address:
+                try:
+                    upstream_response = Message(message)
+                    upstream_response.answers
+                except ValueError as e:
+                    print(f"Dropping malformed message from the authoritative server: {e}")
+                    continue
+
+                # Snapshots and pushed changes arrive in parts, wait until all of them are here
+                if upstream_response.flag in ("0010", "0011"):
+                    try:
+                        records = collect_transfer(transfers, upstream_response)
+                    except ValueError as e:
+                        print(f"Dropping malformed transfer from the authoritative server: {e}")
+                        continue
+                    if records is None:
+                        continue
+
+                # Snapshot sent after subscribing, replaces everything learned from the authoritative server
+                if upstream_response.flag == "0010":
+                    rr_table.load_snapshot(records)
+                    zone_serial = upstream_response.transaction_id
+                    resubscribing = False
+                    if show_table:
+                        rr_table.display_table()
+                    continue
+
+                # Pushed change, apply it in place unless one was missed, then resubscribe to resync
+                if upstream_response.flag == "0011":
+                    serial = upstream_response.transaction_id
+                    if zone_serial is not None and serial <= zone_serial:
+                        # Duplicate or older than what we have, already applied
+                        continue
+                    if zone_serial is None or serial != zone_serial + 1:
+                        if not resubscribing:
+                            print("Missed a change from the authoritative server, resubscribing.")
+                            subscribe(udp_connection, authoritative_address)
+                            resubscribing = True
+                        continue
+                    rr_table.apply_changes(records)
+                    zone_serial = serial
+                    if show_table:
+                        rr_table.display_table()
+                    continue
+
+                # Current serial of the authoritative server, resubscribe if we are behind
+                # (asked again every check while behind, in case the snapshot itself was lost)
+                if upstream_response.flag == "0101":
+                    if upstream_response.transaction_id != zone_serial:
+                        print("Out of date with the authoritative server, resubscribing.")
+                        subscribe(udp_connection, authoritative_address)
+                        resubscribing = True
+                    continue
+
+                # Response to a query, hand the answers to every client waiting on them
+                entry = pending.pop(upstream_response.transaction_id, None)
+                if entry is None:
+                    # Late response for a query that already timed out
+                    continue
+                keys, _ = entry
+
+                answers_by_key = {}
+                for answer in upstream_response.answers:
+                    # Then save the record if valid
+                    if answer["result"] != "Record not found":
+                        rr_table.add_record(
+                            answer["name"],
+                            answer["type"],
+                            answer["result"],
+                            answer["ttl"],
+                            static=0
+                        )
+                        answers_by_key.setdefault((answer["name"], DNSTypes.get_type_code(answer["type"])), []).append(answer)
+
+                for key in keys:
+                    answer_waiters(key, answers_by_key.get(key))
+                # Display RR table
+                if show_table:
+                    rr_table.display_table()
+                continue
+
+            # Drop queries from clients over their rate, before doing any work for them
+            client_address = address
+            if not rate_limiter.allow(client_address, now):
+                continue
+
+            # Only the header and questions are decoded, queries carry no answers
+            try:
+                query = Message(message)
+            except ValueError as e:
+                print(f"Dropping malformed message from {client_address}: {e}")
+                continue
+            print(f"Query from {client_address}: {query}")
+
+            # Check RR table for every question, keyed by (name, type code) so answers go back in question order
+            # records already have the name, type, ttl and result keys an answer needs
+            answers_by_question = {}
+            missing_questions = []
+            for question in query.questions:
+                records = rr_table.lookup(question.name, question.type_code)
+                if records:
+                    answers_by_question[(question.name, question.type_code)] = records
+                else:
+                    missing_questions.append(question)
+
+            # If not found, ask the authoritative DNS server for the missing questions nobody asked it yet
+            if missing_questions:
+                remaining_keys = set()
+                new_questions = []
+                for question in missing_questions:
+                    key = (question.name, question.type_code)
+                    if key not in waiting and key not in remaining_keys:
+                        new_questions.append(question)
+                    remaining_keys.add(key)
+
+                if (new_questions and len(pending) >= max_pending) or waiting_count >= max_waiting:
+                    # Too many upstream queries in flight, shed load by answering from the cache only
+                    print(f"Too many upstream queries in flight, shedding query from {client_address}.")
+                    respond(udp_connection, client_address, query, answers_by_question, "Server busy")
+                    if query_log is not None:
+                        query_log.record(client_address, query, missing_questions, clock() - now)
+                    if show_table:
+                        rr_table.display_table()
+                    continue
 
-            # Else, add "Record not found" in the DNS response
-            # this looks redundant but if no local OR authoritative, build a record not found response
-            if not record:
-                if response["answer"]["result"] == "Record not found":
-                    response = {
-                        "transaction_id": query_data["transaction_id"],
-                        "flag": "0001",
-                        "question": query_data["question"],
-                        "answer": {
-                            "name": name,
-                            "type": query_type,
-                            "ttl": 0,
-                            "result": "Record not found"
-                        }
+                waiter = (client_address, query, answers_by_question, remaining_keys, missing_questions, now)
+                for key in remaining_keys:
+                    waiting.setdefault(key, []).append(waiter)
+                waiting_count += 1
+
+                if new_questions:
+                    print(f"Not found locally, querying authoritative server.")
+                    upstream_transaction_id += 1
+                    upstream_query = {
+                        "transaction_id": upstream_transaction_id,
+                        "flag": "0000",
+                        "questions": [{"name": question.name, "type": question.type} for question in new_questions],
+                        "answers": []
                     }
+                    udp_connection.send_message(serialize(upstream_query), authoritative_address)
+                    pending[upstream_transaction_id] = ([(question.name, question.type_code) for question in new_questions], now)
+                continue
 
             # send response
-            udp_connection.send_message(serialize(response), client_address)
+            respond(udp_connection, client_address, query, answers_by_question, "Record not found")
+            if query_log is not None:
+                query_log.record(client_address, query, missing_questions, clock() - now)
 
             # The format of the DNS query and response is in the project description
 
             # Display RR table
-            rr_table.display_table()
+            if show_table:
+                rr_table.display_table()
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
         # Close UDP socket
         udp_connection.close()
+        if query_log is not None:
+            query_log.close()
+
+
+def subscribe(udp_connection, authoritative_address):
+    # Ask the authoritative server to push record changes to us
+    message = {
+        "transaction_id": 0,
+        "flag": "0010",
+        "questions": [],
+        "answers": []
+    }
+    udp_connection.send_message(serialize(message), authoritative_address)
+
+
+def check_serial(udp_connection, authoritative_address, zone_serial):
+    # Ask the authoritative server for its current serial (and renew our subscription)
+    message = {
+        "transaction_id": zone_serial if zone_serial is not None else -1,
+        "flag": "0101",
+        "questions": [],
+        "answers": []
+    }
+    udp_connection.send_message(serialize(message), authoritative_address)
+
+
+def collect_transfer(transfers, message):
+    """
+    Collects the parts of a snapshot or delta (see amazone.split_transfer) in transfers.
+
+    Returns all the records once every part arrived, None until then.
+    Raises ValueError if the message is not a valid part.
+
+    Examples:
+    >>> transfers = {}
+    >>> collect_transfer(transfers, Message("3,0011,1,1,1/2,0,a.com,8,60,1.1.1.2")) is None
+    True
+    >>> [record["result"] for record in collect_transfer(transfers, Message("3,0011,1,1,0/2,0,a.com,8,60,1.1.1.1"))]
+    ['1.1.1.1', '1.1.1.2']
+    """
+    if len(message.questions) != 1:
+        raise ValueError("Transfer part without its index/count question")
+    index, _, count = message.questions[0].name.partition("/")
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"Transfer part {index} of {count}")
+
+    # Parts of transfers that never completed are not kept around forever
+    key = (message.flag, message.transaction_id)
+    if key not in transfers and len(transfers) >= 16:
+        transfers.clear()
+    parts = transfers.setdefault(key, {})
+    parts[index] = message.answers
+    if len(parts) < count:
+        return None
+    del transfers[key]
+    return [record for i in range(count) for record in parts[i]]
+
+
+def respond(udp_connection, client_address, query, answers_by_question, missing_result):
+    # if no local OR authoritative answer for a question, answer it with missing_result
+    # ("Record not found", or "Server busy" when the query was shed or timed out)
+    answers = []
+    for question in query.questions:
+        answers += answers_by_question.get((question.name, question.type_code)) or [{
+            "name": question.name,
+            "type": question.type,
+            "ttl": 0,
+            "result": missing_result
+        }]
+
+    udp_connection.send_message(serialize_response(query, answers), client_address)
 
 
 def main():
@@ -116,6 +350,7 @@ def main():
     # if you want to test: run with listen uncommented in one terminal
     # then open new terminal and comment out listen, uncomment test_udp_send
     # "question" can be changed if you want to test other inputs
+    # to record queries for replay_query_log, use listen(rr_table, query_log=QueryLog("queries.log.gz"))
     listen(rr_table)
     #test_udp_send()
     
@@ -125,66 +360,275 @@ def test_udp_send():
     message = {
         "transaction_id": 1,
         "flag": "0000",
-        "question": {"name": "dns.amazone.com", "type": "A"},
-        "answer": {}
+        "questions": [{"name": "dns.amazone.com", "type": "A"}],
+        "answers": []
     }
     client.send_message(serialize(message), ("127.0.0.1", 21000))
     response, _ = client.receive_message()
     print("Response from server:", response)
 
+def replay_query_log(path, address=("127.0.0.1", 21000), speed=1.0, connection_factory=None):
+    # load generator: send the queries recorded by a QueryLog to the local server at address,
+    # keeping their original spacing divided by speed (0 sends as fast as possible)
+    # each logged client gets its own connection so per-client rate limiting sees the same traffic
+    # run with: python -c "import localserver; localserver.replay_query_log('queries.log.gz')"
+    connection_factory = connection_factory if connection_factory is not None else UDPConnection
+
+    # Lines of one query share timestamp and client, put their questions back together
+    queries = []
+    with gzip.open(path, "rt") as log_file:
+        try:
+            for line in log_file:
+                # The last line of a log cut off while it was written has no newline
+                if not line.endswith("\n"):
+                    break
+                timestamp, host, port, name, type_code, _, _ = line.rstrip("\n").split(",")
+                question = {"name": name, "type": DNSTypes.get_type_name(int(type_code))}
+                if queries and queries[-1][0] == (timestamp, host, port):
+                    queries[-1][1].append(question)
+                else:
+                    queries.append(((timestamp, host, port), [question]))
+        except EOFError:
+            # The log is still being written, or its server was killed: the last gzip member is
+            # unfinished, everything up to its last flush was read
+            pass
+
+    sent_at = {}
+    latencies = []
+    done = threading.Event()
+
+    def receive(connection):
+        while True:
+            message, _ = connection.receive_message(wait_forever=False)
+            if message is None:
+                if done.is_set():
+                    return
+                continue
+            latencies.append(time.perf_counter() - sent_at[Message(message).transaction_id])
+
+    connections = {}
+    receivers = []
+    start = time.perf_counter()
+    first_timestamp = float(queries[0][0][0]) if queries else 0
+    for transaction_id, ((timestamp, host, port), questions) in enumerate(queries):
+        if speed:
+            delay = (float(timestamp) - first_timestamp) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        connection = connections.get((host, port))
+        if connection is None:
+            connection = connections[(host, port)] = connection_factory()
+            receivers.append(threading.Thread(target=receive, args=(connection,), daemon=True))
+            receivers[-1].start()
+
+        query = {"transaction_id": transaction_id, "flag": "0000", "questions": questions, "answers": []}
+        sent_at[transaction_id] = time.perf_counter()
+        connection.send_message(serialize(query), address)
+
+    # Receivers stop after their next timeout with nothing left to receive
+    done.set()
+    for receiver in receivers:
+        receiver.join()
+    for connection in connections.values():
+        connection.close()
+
+    latencies.sort()
+    print(f"Replayed {len(queries)} queries from {len(connections)} clients, {len(latencies)} answered")
+    if latencies:
+        print(f"latency p50: {latencies[len(latencies) // 2] * 1000:.2f} ms, p99: {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    return latencies
+
 def serialize(message: dict) -> str:
-    # converting from DNS format (dict) to str 
+    # converting from DNS format (dict) to str
     # uses provided DNStypes class
-    qname = message["question"]["name"]
-    qtype = DNSTypes.get_type_code(message["question"]["type"]) or 0
-    aname = message.get("answer", {}).get("name", "") or ""
-    atype = DNSTypes.get_type_code(message.get("answer", {}).get("type", "")) or 0
-    ttl = message.get("answer", {}).get("ttl", "") or None
-    result = message.get("answer", {}).get("result", "") or ""
-    return f"{message['transaction_id']},{message['flag']},{qname},{qtype},{aname},{atype},{ttl},{result}"
+    # header carries the question and answer counts so one message can hold several of each:
+    # transaction_id,flag,qdcount,ancount,(qname,qtype)*,(aname,atype,ttl,result)*
+    questions = message.get("questions", [])
+    answers = message.get("answers", [])
+    fields = [str(message["transaction_id"]), message["flag"], str(len(questions)), str(len(answers))]
+    for question in questions:
+        fields += [question["name"], str(DNSTypes.get_type_code(question["type"]) or 0)]
+    for answer in answers:
+        fields += [answer["name"], str(DNSTypes.get_type_code(answer["type"]) or 0), str(answer["ttl"]), answer["result"]]
+    return ",".join(fields)
 
 def deserialize(data: str) -> dict:
     # converting from string back to DNS dict
     fields = data.split(',')
+    question_count = int(fields[2])
+    answer_count = int(fields[3])
+    index = 4
+
+    questions = []
+    for _ in range(question_count):
+        questions.append({
+            "name": fields[index],
+            "type": DNSTypes.get_type_name(int(fields[index + 1]))
+        })
+        index += 2
+
+    answers = []
+    for _ in range(answer_count):
+        answers.append({
+            "name": fields[index],
+            "type": DNSTypes.get_type_name(int(fields[index + 1])),
+            "ttl": int(fields[index + 2]) if fields[index + 2] not in ("", "None") else None,
+            "result": fields[index + 3]
+        })
+        index += 4
+
     return {
         "transaction_id": int(fields[0]),
         "flag": fields[1],
-        "question": {
-            "name": fields[2],
-            "type": DNSTypes.get_type_name(int(fields[3])) if fields[3] != "" else ""
-        },
-        "answer": {
-            "name": fields[4],
-            "type": DNSTypes.get_type_name(int(fields[5])) if fields[5] not in ("", "None") else "",
-            "ttl": int(fields[6]) if fields[6] and fields[6] != "None" else None,
-            "result": fields[7] if len(fields) > 7 else ""
-        }
+        "questions": questions,
+        "answers": answers
     }
 
+def serialize_response(query, answers) -> str:
+    # Response to a parsed query (Message), the question section is sent back as it was received
+    fields = [str(query.transaction_id), "0001", str(len(query.questions)), str(len(answers))]
+    if query.questions:
+        fields.append(query.question_section)
+    for answer in answers:
+        fields += [answer["name"], str(DNSTypes.get_type_code(answer["type"]) or 0), str(answer["ttl"]), answer["result"]]
+    return ",".join(fields)
+
+class Question:
+    """A question of a Message, with its type as both the DNSTypes code and name."""
+
+    __slots__ = ("name", "type_code", "type")
+
+    def __init__(self, name: str, type_code: int):
+        self.name = name
+        self.type_code = type_code
+        self.type = DNSTypes.code_to_name.get(type_code)
+
+    def __repr__(self):
+        return f"Question({self.name!r}, {self.type!r})"
+
+class Message:
+    """
+    A DNS message parsed from the format produced by serialize.
+
+    Only the header and questions are parsed when the message is created. Answers are
+    decoded on first access, incoming queries never look at them.
+
+    Examples:
+    >>> message = Message("7,0000,2,0,shop.amazone.com,8,shop.amazone.com,4")
+    >>> message.transaction_id, message.flag, message.questions
+    (7, '0000', [Question('shop.amazone.com', 'A'), Question('shop.amazone.com', 'AAAA')])
+    >>> message.questions[1].type_code == DNSTypes.get_type_code('AAAA')
+    True
+    >>> Message("7,0001,0,1,shop.amazone.com,8,60,3.33.147.88").answers
+    [{'name': 'shop.amazone.com', 'type': 'A', 'ttl': 60, 'result': '3.33.147.88'}]
+    >>> Message("garbage")
+    Traceback (most recent call last):
+    ...
+    ValueError: Malformed message header: 'garbage'
+    """
+
+    __slots__ = ("transaction_id", "flag", "questions", "question_section", "_answer_count", "_answer_section", "_answers")
+
+    def __init__(self, data: str):
+        # Raises ValueError if data is not a well formed message
+        header = data.split(',', 4)
+        if len(header) < 4:
+            raise ValueError(f"Malformed message header: {data[:40]!r}")
+        self.transaction_id = int(header[0])
+        self.flag = header[1]
+        question_count = int(header[2])
+        self._answer_count = int(header[3])
+        if question_count < 0 or self._answer_count < 0:
+            raise ValueError(f"Malformed message counts: {data[:40]!r}")
+        body = header[4] if len(header) > 4 else ""
+        self._answers = None
+
+        if not question_count:
+            self.questions = []
+            self.question_section = ""
+            self._answer_section = body
+            return
+
+        # Split off the questions only, the answers stay one unparsed string
+        fields = body.split(',', 2 * question_count)
+        if len(fields) < 2 * question_count + (1 if self._answer_count else 0):
+            raise ValueError(f"Message shorter than its question count: {data[:40]!r}")
+        if self._answer_count:
+            self._answer_section = fields.pop()
+            self.question_section = body[:len(body) - len(self._answer_section) - 1]
+        else:
+            self._answer_section = ""
+            self.question_section = body
+        self.questions = list(map(Question, fields[::2], map(int, fields[1::2])))
+
+    @property
+    def answers(self):
+        """The answers as dicts, raises ValueError if the answer section does not match its count"""
+        if self._answers is None:
+            fields = self._answer_section.split(',')
+            if self._answer_count and len(fields) != 4 * self._answer_count:
+                raise ValueError(f"Answer section does not hold {self._answer_count} answers")
+            self._answers = [
+                {
+                    "name": fields[i],
+                    "type": DNSTypes.get_type_name(int(fields[i + 1])),
+                    "ttl": int(fields[i + 2]) if fields[i + 2] not in ("", "None") else None,
+                    "result": fields[i + 3]
+                }
+                for i in range(0, 4 * self._answer_count, 4)
+            ]
+        return self._answers
+
+    def __repr__(self):
+        return f"Message({self.transaction_id}, {self.flag!r}, {self.questions})"
+
 class RRTable:
-    def __init__(self):
+    def __init__(self, clock=time.monotonic, expire_in_background=True):
         self.records = []
         self.record_number = 0
+        # (name, DNSTypes code) -> records, so the query path finds records without scanning the table
+        self.index = {}
+
+        # ttls count down by the clock, pass a SimulatedClock and expire_in_background=False
+        # to move time by hand and call expire() yourself
+        self.clock = clock
+        self.last_expiry = clock()
 
         # Start the background thread
         self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
-        self.thread.start()
+        if expire_in_background:
+            self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
+            self.thread.start()
 
     def add_record(self, name, type, result, ttl, static):
         with self.lock:
-            self.record_number += 1
+            self.__append_record(name, type, result, ttl, static)
 
-            record = {
-                "record_number": self.record_number,
-                "name": name,
-                "type": type,
-                "result": result,
-                "ttl": ttl,
-                "static": static
-            }
+    def __append_record(self, name, type, result, ttl, static):
+        # This method is only called within a locked context
+        # a record with the same name, type and result is refreshed instead of stored twice
+        key = (name, DNSTypes.get_type_code(type))
+        for record in self.index.get(key, []):
+            if record["result"] == result:
+                if record["static"] == 0:
+                    record["ttl"] = ttl
+                    record["static"] = static
+                return
 
-            self.records.append(record)
+        self.record_number += 1
+
+        record = {
+            "record_number": self.record_number,
+            "name": name,
+            "type": type,
+            "result": result,
+            "ttl": ttl,
+            "static": static
+        }
+
+        self.records.append(record)
+        self.index.setdefault(key, []).append(record)
 
     # letting user specify type (extra credit in client.py)  
     def get_record(self, name, type):
@@ -193,6 +637,39 @@ class RRTable:
                 if record["name"] == name and record["type"] == type:
                     return record
 
+    def get_records(self, name, type):
+        # Every record matching name and type, a name can have several A records
+        return list(self.lookup(name, DNSTypes.get_type_code(type)))
+
+    def lookup(self, name, type_code):
+        # Records for name and a DNSTypes code straight from the index, used on the query path
+        # the returned list belongs to the table, do not modify it
+        with self.lock:
+            return self.index.get((name, type_code), [])
+
+    def apply_changes(self, changes):
+        # Changes pushed by the authoritative server, each one replaces the cached record with the
+        # same name, type and result, ttl 0 means the record was removed
+        with self.lock:
+            for change in changes:
+                if change["ttl"] != 0:
+                    self.__append_record(change["name"], change["type"], change["result"], change["ttl"], 0)
+                    continue
+                key = (change["name"], DNSTypes.get_type_code(change["type"]))
+                for record in [record for record in self.index.get(key, []) if record["static"] == 0 and record["result"] == change["result"]]:
+                    self.records.remove(record)
+                    self.index[key].remove(record)
+            self.__update_record_numbers()
+
+    def load_snapshot(self, records):
+        # Replace every cached (non-static) record with the authoritative server's records
+        with self.lock:
+            self.records = [record for record in self.records if record["static"] == 1]
+            self.__update_record_numbers()
+            for record in records:
+                self.__append_record(record["name"], record["type"], record["result"], record["ttl"], 0)
+            self.__update_record_numbers()
+
     def display_table(self):
         with self.lock:
             # Display the table in the following format (include the column names):
@@ -204,31 +681,43 @@ class RRTable:
             for record in self.records:
                 print(f"{record['record_number']},{record['name']},{record['type']},{record['result']},{record['ttl']},{record['static']}")
 
+    def expire(self):
+        # Decrement ttls by the whole seconds passed on the clock since the last call
+        with self.lock:
+            elapsed = int(self.clock() - self.last_expiry)
+            if elapsed > 0:
+                self.last_expiry += elapsed
+                self.__remove_expired_records(elapsed)
+
     def __decrement_ttl(self):
         while True:
-            with self.lock:
-                # Decrement ttl
-                self.__remove_expired_records()
+            self.expire()
             time.sleep(1)
 
-    def __remove_expired_records(self):
+    def __remove_expired_records(self, elapsed):
         # This method is only called within a locked context
         new_records = []
 
         # Remove expired records
         for record in self.records:
             if record['static'] == 0 and record['ttl'] != None:
-                record['ttl'] -= 1
+                record['ttl'] -= elapsed
             
             # if record is still valid or set to static
             if record['static'] == 1 or record['ttl'] == None or record['ttl'] > 0:
                 new_records.append(record)
         self.records = new_records
+        self.__update_record_numbers()
 
-        # Update record numbers
+    def __update_record_numbers(self):
+        # This method is only called within a locked context
+        # called after records were removed, so the index is rebuilt here too
+        index = {}
         for i, record in enumerate(self.records, start = 1):
             record['record_number'] = i
+            index.setdefault((record["name"], DNSTypes.get_type_code(record["type"])), []).append(record)
         self.record_number = len(self.records)
+        self.index = index
 
 class DNSTypes:
     """
@@ -261,6 +750,146 @@ class DNSTypes:
         return DNSTypes.code_to_name.get(type_code, None)
 
 
+class RateLimiter:
+    """
+    Per-client token bucket rate limiting for the local server.
+
+    Each client address gets a bucket of `burst` tokens refilled at `rate` tokens per second,
+    and every query spends one token. Buckets are kept in least recently seen order so at most
+    `max_clients` are tracked; the quietest client is forgotten first. Each check is O(1).
+
+    Examples:
+    >>> limiter = RateLimiter(rate=1, burst=2)
+    >>> [limiter.allow(("127.0.0.1", 5000), now=0) for _ in range(3)]
+    [True, True, False]
+    >>> limiter.allow(("127.0.0.1", 5000), now=1)
+    True
+    """
+
+    def __init__(self, rate: float = 20, burst: float = 40, max_clients: int = 1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client_address -> [tokens, last_refill]
+        self.buckets = OrderedDict()
+
+    def allow(self, client_address: tuple[str, int], now: float = None) -> bool:
+        """Spends a token for the client, returns False if the client is over its rate."""
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get(client_address)
+        if bucket is None:
+            if len(self.buckets) >= self.max_clients:
+                self.buckets.popitem(last=False)
+            bucket = [self.burst, now]
+            self.buckets[client_address] = bucket
+        else:
+            self.buckets.move_to_end(client_address)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+
+class QueryLog:
+    """
+    Non-blocking query log for the local server.
+
+    record() only puts the query on a bounded queue. A background thread writes it out
+    gzip-compressed to path, one line per question:
+
+        timestamp,client_host,client_port,name,type_code,hit,latency_us
+
+    Every flush_interval seconds the thread drains the queue, writes the batch and flushes it, so
+    the file can be read while the server runs (replay_query_log reads up to the last flush).
+    A log already at path is rotated away on start, and after max_bytes of lines the file is
+    rotated to path.1 (path.1 to path.2 and so on, keeping backup_count files, 0 keeps none).
+    When the queue is full entries are dropped and counted in dropped, so the query path never
+    waits on the disk; max_queue should hold flush_interval seconds of queries.
+    """
+
+    def __init__(self, path: str, max_queue: int = 10000, max_bytes: int = 64 * 1024 * 1024, backup_count: int = 5, flush_interval: float = 1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # deque appends and pops are atomic, so record() needs no lock
+        self.entries = deque()
+        self.max_queue = max_queue
+        self.dropped = 0
+
+        # Opened here so a bad path fails now instead of in the background thread
+        # always a fresh file, so written counts every line in it
+        if os.path.exists(self.path):
+            self.__rotate()
+        self.log_file = gzip.open(self.path, "wt")
+        self.written = 0
+
+        # Start the background thread
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.__write_entries, daemon=True)
+        self.thread.start()
+
+    def record(self, client_address: tuple[str, int], query, missing_questions, latency: float):
+        """Logs a query (Message), questions in missing_questions were not answered from the cache."""
+        if len(self.entries) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.entries.append((time.time(), client_address, query.questions, missing_questions, latency))
+
+    def close(self):
+        """Writes out what is still queued and closes the log."""
+        # Never waits on the queue, so this returns even if the writer thread died (disk full)
+        self.closing.set()
+        self.thread.join()
+
+    def __write_entries(self):
+        # Sleeps between batches instead of waking up for every query, the thread would
+        # otherwise compete with listen for the CPU on every query
+        try:
+            while True:
+                closing = self.closing.wait(self.flush_interval)
+                self.__write_batch()
+                if closing:
+                    break
+        finally:
+            self.log_file.close()
+
+    def __write_batch(self):
+        # Everything queued so far, written as one string and flushed
+        lines = []
+        while self.entries:
+            timestamp, (host, port), questions, missing_questions, latency = self.entries.popleft()
+            for question in questions:
+                hit = 0 if question in missing_questions else 1
+                lines.append(f"{timestamp:.6f},{host},{port},{question.name},{question.type_code},{hit},{int(latency * 1e6)}\n")
+        if not lines:
+            return
+
+        batch = "".join(lines)
+        self.log_file.write(batch)
+        # Flushing makes the batch readable while the log is still open (see replay_query_log)
+        self.log_file.flush()
+        self.written += len(batch)
+
+        if self.written >= self.max_bytes:
+            self.log_file.close()
+            self.__rotate()
+            self.log_file = gzip.open(self.path, "wt")
+            self.written = 0
+
+    def __rotate(self):
+        if self.backup_count == 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
 class UDPConnection:
     """A class to handle UDP socket communication, capable of acting as both a client and a server."""
 
@@ -274,10 +903,13 @@ class UDPConnection:
         """Sends a message to the specified address."""
         self.socket.sendto(message.encode(), address)
 
-    def receive_message(self):
+    def receive_message(self, wait_forever: bool = True):
         """
         Receives a message from the socket.
 
+        Args:
+            wait_forever: Keep waiting across socket timeouts. If False, return (None, None) on timeout.
+
         Returns:
             tuple (data, address): The received message and the address it came from.
 
@@ -288,7 +920,13 @@ class UDPConnection:
             try:
                 data, address = self.socket.recvfrom(4096)
                 return data.decode(), address
+            except UnicodeDecodeError:
+                # Not a message of ours, drop it like any other malformed datagram
+                print(f"Dropping datagram from {address} that is not text.")
+                continue
             except socket.timeout:
+                if not wait_forever:
+                    return None, None
                 continue
             except OSError as e:
                 if e.errno == errno.ECONNRESET:
@@ -313,5 +951,118 @@ class UDPConnection:
         self.socket.close()
 
 
+
+class SimulatedClock:
+    """
+    A clock that only moves when told to, can be passed anywhere a clock (time.monotonic) is expected.
+
+    Examples:
+    >>> clock = SimulatedClock()
+    >>> clock.advance(2.5)
+    >>> clock()
+    2.5
+    """
+
+    def __init__(self, start: float = 0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        """Moves the clock forward by the given number of seconds."""
+        self.now += seconds
+
+
+class LoopbackNetwork:
+    """Connects LoopbackConnections in the same process by address, standing in for the real network."""
+
+    def __init__(self):
+        self.inboxes = {}
+        self.next_port = 50000
+        self.lock = threading.Lock()
+
+    def register(self, address: tuple[str, int], inbox: queue.Queue):
+        """Delivers messages sent to address into inbox."""
+        with self.lock:
+            if address in self.inboxes:
+                raise OSError(errno.EADDRINUSE, f"Address already in use: {address}")
+            self.inboxes[address] = inbox
+
+    def ephemeral_address(self):
+        """Picks a free address for a connection that sends before binding, like the OS does for UDP."""
+        with self.lock:
+            while ("127.0.0.1", self.next_port) in self.inboxes:
+                self.next_port += 1
+            self.next_port += 1
+            return ("127.0.0.1", self.next_port - 1)
+
+    def unregister(self, address: tuple[str, int]):
+        with self.lock:
+            self.inboxes.pop(address, None)
+
+    def deliver(self, data: bytes, source: tuple[str, int], destination: tuple[str, int]):
+        """Queues the datagram for the destination, dropped if nothing is bound there (like UDP)."""
+        inbox = self.inboxes.get(destination)
+        if inbox is not None:
+            inbox.put((data, source))
+
+
+class LoopbackConnection:
+    """
+    Drop-in replacement for UDPConnection that sends messages through a LoopbackNetwork,
+    so servers and clients can run as threads of one process without real sockets.
+    """
+
+    # Like UDPConnection, only this many bytes of a datagram are received and the rest is lost
+    buffer_size = 4096
+    # Largest UDP payload, sending more raises OSError like sendto does
+    max_datagram_size = 65507
+
+    def __init__(self, network: LoopbackNetwork, timeout: float = 1):
+        self.network = network
+        self.timeout = timeout
+        self.inbox = queue.Queue()
+        self.address = None
+        self.is_bound = False
+
+    def send_message(self, message: str, address: tuple[str, int]):
+        """Sends a message to the specified address."""
+        if len(message.encode()) > self.max_datagram_size:
+            raise OSError(errno.EMSGSIZE, "Message too long")
+        if self.address is None:
+            self.bind(self.network.ephemeral_address())
+        self.network.deliver(message.encode(), self.address, address)
+
+    def receive_message(self, wait_forever: bool = True):
+        """Receives a message, same contract as UDPConnection.receive_message."""
+        while True:
+            try:
+                data, address = self.inbox.get(timeout=self.timeout)
+            except queue.Empty:
+                if not wait_forever:
+                    return None, None
+                continue
+            # Decoded like UDPConnection does, datagrams that are not text are dropped
+            try:
+                return data[:self.buffer_size].decode(), address
+            except UnicodeDecodeError:
+                print(f"Dropping datagram from {address} that is not text.")
+
+    def bind(self, address: tuple[str, int]):
+        """Binds the connection to the given address. This means it will be a server."""
+        if self.is_bound:
+            print(f"Socket is already bound to address: {self.address}")
+            return
+        self.network.register(address, self.inbox)
+        self.address = address
+        self.is_bound = True
+
+    def close(self):
+        """Closes the connection, messages sent to its address are dropped from now on."""
+        if self.address is not None:
+            self.network.unregister(self.address)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,589 @@
+"""
+Tests for the local and authoritative servers, run with: python -m pytest
+
+The servers run as threads on a LoopbackNetwork, and RRTables and the local server's timeouts
+run on a SimulatedClock, so nothing binds real ports and nothing waits on the wall clock: a test
+moves time with clock.advance() and then waits for the servers to react.
+"""
+import contextlib
+import errno
+import gzip
+import os
+import threading
+import time
+
+import pytest
+
+import amazone
+import localserver
+from localserver import LoopbackConnection, LoopbackNetwork, Message, RateLimiter, RRTable, SimulatedClock
+
+AUTHORITATIVE_ADDRESS = ("127.0.0.1", 22000)
+LOCAL_ADDRESS = ("127.0.0.1", 21000)
+
+
+def wait_for(condition, timeout=5):
+    # Polls condition until it is true, fails the test after timeout seconds
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail("timed out waiting for the servers")
+        time.sleep(0.01)
+
+
+def receive(connection, timeout=5):
+    # The next message on connection, fails the test instead of waiting forever if none comes
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        message, _ = connection.receive_message(wait_forever=False)
+        if message is not None:
+            return message
+    pytest.fail("timed out waiting for a message")
+
+
+@contextlib.contextmanager
+def running(*servers):
+    # Runs (listen, args, kwargs) servers as threads, stops them on exit
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=listen, args=args, kwargs={**kwargs, "stop": stop})
+        for listen, args, kwargs in servers
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def authoritative_server(network, rr_table):
+    connection = LoopbackConnection(network, timeout=0.05)
+    connection.bind(AUTHORITATIVE_ADDRESS)
+    return amazone.listen, (rr_table, connection), {}
+
+
+def local_server(network, rr_table, **kwargs):
+    # Upstream timeouts and serial checks only happen when the test advances the clock
+    kwargs.setdefault("clock", SimulatedClock())
+    kwargs.setdefault("rate_limiter", RateLimiter(burst=float("inf")))
+    return localserver.listen, (rr_table,), {"udp_connection": LoopbackConnection(network, timeout=0.05), **kwargs}
+
+
+def local_table():
+    return RRTable(clock=SimulatedClock(), expire_in_background=False)
+
+
+def resolve(network, name, type="A", transaction_id=1):
+    return resolve_questions(network, [(name, type)], transaction_id)
+
+
+def resolve_questions(network, questions, transaction_id=1):
+    # Sends one query with every (name, type) in questions, returns the response Message
+    client = LoopbackConnection(network)
+    query = {"transaction_id": transaction_id, "flag": "0000", "questions": [{"name": name, "type": type} for name, type in questions]}
+    client.send_message(localserver.serialize(query), LOCAL_ADDRESS)
+    message = receive(client)
+    client.close()
+    return Message(message)
+
+
+# RRTable
+
+def test_expire_counts_down_whole_seconds_on_the_clock():
+    clock = SimulatedClock()
+    rr_table = RRTable(clock=clock, expire_in_background=False)
+    rr_table.add_record("cached.com", "A", "1.1.1.1", 3, 0)
+    rr_table.add_record("static.com", "A", "2.2.2.2", None, 1)
+
+    clock.advance(2.5)
+    rr_table.expire()
+    assert rr_table.get_records("cached.com", "A")[0]["ttl"] == 1
+
+    # The half second left over counts towards the next tick
+    clock.advance(0.5)
+    rr_table.expire()
+    assert rr_table.get_records("cached.com", "A") == []
+    assert [record["name"] for record in rr_table.records] == ["static.com"]
+    assert rr_table.records[0]["record_number"] == 1
+
+
+def test_add_record_refreshes_instead_of_duplicating():
+    rr_table = local_table()
+    rr_table.add_record("a.com", "A", "1.1.1.1", 10, 0)
+    rr_table.add_record("a.com", "A", "1.1.1.1", 60, 0)
+    rr_table.add_record("a.com", "A", "1.1.1.2", 60, 0)
+
+    assert [(record["result"], record["ttl"]) for record in rr_table.get_records("a.com", "A")] == [("1.1.1.1", 60), ("1.1.1.2", 60)]
+    assert len(rr_table.records) == 2
+
+
+def test_lookup_is_by_type_code():
+    rr_table = local_table()
+    rr_table.add_record("a.com", "A", "1.1.1.1", 10, 0)
+    rr_table.add_record("a.com", "AAAA", "::1", 10, 0)
+
+    assert [record["result"] for record in rr_table.lookup("a.com", localserver.DNSTypes.get_type_code("AAAA"))] == ["::1"]
+
+
+# RateLimiter
+
+def test_rate_limiter_refills_at_rate():
+    limiter = RateLimiter(rate=2, burst=2)
+    client = ("127.0.0.1", 5000)
+    assert [limiter.allow(client, now=0) for _ in range(3)] == [True, True, False]
+    # Half a second at 2 tokens per second is one more query
+    assert [limiter.allow(client, now=0.5) for _ in range(2)] == [True, False]
+    # Never more than burst, however long the client was quiet
+    assert [limiter.allow(client, now=100) for _ in range(3)] == [True, True, False]
+
+
+def test_rate_limiter_forgets_least_recently_seen_client():
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    first, second, third = ("127.0.0.1", 1), ("127.0.0.1", 2), ("127.0.0.1", 3)
+    limiter.allow(first, now=0)
+    limiter.allow(second, now=0)
+    assert not limiter.allow(first, now=0)
+    limiter.allow(third, now=0)
+
+    assert list(limiter.buckets) == [first, third]
+    # second starts over with a full bucket
+    assert limiter.allow(second, now=0)
+
+
+# Message
+
+def test_message_without_questions_or_answers():
+    message = Message("3,0101,0,0")
+    assert (message.transaction_id, message.flag, message.questions, message.answers) == (3, "0101", [], [])
+
+
+def test_message_answers_with_no_ttl():
+    message = Message("1,0001,1,1,www.csusm.edu,8,www.csusm.edu,8,None,144.37.5.45")
+    assert message.answers == [{"name": "www.csusm.edu", "type": "A", "ttl": None, "result": "144.37.5.45"}]
+
+
+@pytest.mark.parametrize("data", [
+    "",
+    "1,0000",
+    "x,0000,1,0,a.com,8",
+    "1,0000,-1,0",
+    "1,0000,2,0,a.com,8",
+    "1,0000,1,0,a.com,A",
+])
+def test_malformed_message_raises_value_error(data):
+    with pytest.raises(ValueError):
+        Message(data)
+
+
+def test_answer_count_mismatch_raises_on_access():
+    message = Message("1,0001,1,2,a.com,8,a.com,8,60,1.1.1.1")
+    assert message.questions[0].name == "a.com"
+    with pytest.raises(ValueError):
+        message.answers
+
+
+# Loopback transport
+
+def test_loopback_connection_keeps_udp_limits():
+    network = LoopbackNetwork()
+    receiver = LoopbackConnection(network)
+    receiver.bind(LOCAL_ADDRESS)
+    sender = LoopbackConnection(network)
+
+    sender.send_message("x" * 5000, LOCAL_ADDRESS)
+    message = receive(receiver)
+    assert len(message) == 4096
+
+    with pytest.raises(OSError):
+        sender.send_message("x" * 70000, LOCAL_ADDRESS)
+
+
+# Servers
+
+def test_resolution_from_snapshot_and_upstream():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.88", 60, 1)
+    cache = local_table()
+
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache)):
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+        response = resolve(network, "shop.amazone.com")
+        assert response.flag == "0001"
+        assert [(answer["name"], answer["result"]) for answer in response.answers] == [("shop.amazone.com", "3.33.147.88")]
+
+        response = resolve(network, "missing.amazone.com", transaction_id=2)
+        assert response.transaction_id == 2
+        assert [answer["result"] for answer in response.answers] == ["Record not found"]
+        # Negative answers are not cached
+        assert cache.lookup("missing.amazone.com", 8) == []
+
+
+def test_snapshot_larger_than_a_datagram():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    for i in range(300):
+        authoritative_table.add_record(f"host{i}.amazone.com", "A", "10.0.0.1", 60, 1)
+    cache = local_table()
+
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache)):
+        wait_for(lambda: len(cache.records) == 300)
+        assert [answer["result"] for answer in resolve(network, "host299.amazone.com").answers] == ["10.0.0.1"]
+
+
+def lose_next_delta(authoritative_table, name, result):
+    # Changes the authoritative table without pushing the delta, as if it was lost on the way
+    listeners = authoritative_table.listeners[:]
+    authoritative_table.listeners.clear()
+    authoritative_table.add_record(name, "A", result, 60, 1)
+    authoritative_table.listeners.extend(listeners)
+
+
+def test_resubscribes_after_a_lost_delta():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.88", 60, 1)
+    cache = local_table()
+
+    # The clock never moves, so only the gap in serials can bring the lost change back
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache)):
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+        lose_next_delta(authoritative_table, "lost.amazone.com", "1.1.1.1")
+
+        # The next delta skips a serial, the local server resubscribes and gets both changes
+        authoritative_table.add_record("next.amazone.com", "A", "1.1.1.2", 60, 1)
+        wait_for(lambda: cache.lookup("lost.amazone.com", 8) and cache.lookup("next.amazone.com", 8))
+
+
+def test_serial_check_notices_a_lost_delta_while_idle():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.88", 60, 1)
+    cache = local_table()
+    clock = SimulatedClock()
+
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache, clock=clock, serial_check_interval=5)):
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+        lose_next_delta(authoritative_table, "lost.amazone.com", "1.1.1.1")
+
+        # Nothing else changes, only the serial check can find out
+        clock.advance(5)
+        wait_for(lambda: cache.lookup("lost.amazone.com", 8))
+
+
+def received_flags(connection):
+    # Flags of every message already waiting on connection
+    flags = []
+    while True:
+        message, _ = connection.receive_message(wait_forever=False)
+        if message is None:
+            return flags
+        flags.append(Message(message).flag)
+
+
+def send_transfer(connection, flag, serial, records):
+    for part in amazone.split_transfer(flag, serial, records):
+        connection.send_message(part, LOCAL_ADDRESS)
+
+
+def test_burst_of_deltas_after_a_gap_resubscribes_once():
+    network = LoopbackNetwork()
+    # Stands in for the authoritative server so the subscribes can be counted
+    authoritative = LoopbackConnection(network, timeout=0.05)
+    authoritative.bind(AUTHORITATIVE_ADDRESS)
+    cache = local_table()
+    record = {"name": "shop.amazone.com", "type": "A", "ttl": 60, "result": "3.33.147.88"}
+
+    # The clock never moves, so no serial checks are sent
+    with running(local_server(network, cache, clock=SimulatedClock())):
+        assert Message(receive(authoritative)).flag == "0010"
+        send_transfer(authoritative, "0010", 1, [record])
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+
+        # A repeat of an old delta is ignored, then serial 2 is lost and 3 to 5 arrive
+        send_transfer(authoritative, "0011", 1, [{**record, "result": "1.1.1.1"}])
+        for serial in (3, 4, 5):
+            send_transfer(authoritative, "0011", serial, [{**record, "name": f"host{serial}.amazone.com"}])
+        # The local server handles messages in order, once this is answered the deltas were seen
+        resolve(network, "shop.amazone.com")
+
+        assert received_flags(authoritative) == ["0010"]
+        assert [record["result"] for record in cache.records] == ["3.33.147.88"]
+
+    authoritative.close()
+
+
+def test_subscribers_that_stop_renewing_are_dropped():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    clock = SimulatedClock()
+    authoritative = authoritative_server(network, authoritative_table)
+    authoritative[2].update(clock=clock, subscriber_timeout=15)
+    # Stands in for a local server
+    local = LoopbackConnection(network, timeout=0.05)
+    local.bind(LOCAL_ADDRESS)
+    serial_check = "0,0101,0,0"
+
+    with running(authoritative):
+        local.send_message(serial_check, AUTHORITATIVE_ADDRESS)
+        assert Message(receive(local)).flag == "0101"
+
+        authoritative_table.add_record("a.amazone.com", "A", "1.1.1.1", 60, 1)
+        assert Message(receive(local)).flag == "0011"
+
+        # No renewal for longer than subscriber_timeout, the next change is not pushed
+        clock.advance(16)
+        authoritative_table.add_record("b.amazone.com", "A", "1.1.1.2", 60, 1)
+        local.send_message(serial_check, AUTHORITATIVE_ADDRESS)
+        assert Message(receive(local)).flag == "0101"
+
+        # Renewed by that serial check, changes are pushed again
+        authoritative_table.add_record("c.amazone.com", "A", "1.1.1.3", 60, 1)
+        assert Message(receive(local)).flag == "0011"
+
+    local.close()
+
+
+def test_query_with_several_questions_answers_in_question_order():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.88", 60, 1)
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.89", 60, 1)
+    authoritative_table.add_record("shop.amazone.com", "NS", "dns.amazone.com", 60, 1)
+    cache = local_table()
+
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache)):
+        wait_for(lambda: cache.lookup("shop.amazone.com", 1))
+
+        # AAAA is not cached and goes upstream, the others come from the cache
+        response = resolve_questions(network, [("shop.amazone.com", "AAAA"), ("shop.amazone.com", "A"), ("shop.amazone.com", "NS")])
+        assert [question.type for question in response.questions] == ["AAAA", "A", "NS"]
+        assert [(answer["type"], answer["result"]) for answer in response.answers] == [
+            ("AAAA", "Record not found"),
+            ("A", "3.33.147.88"),
+            ("A", "3.33.147.89"),
+            ("NS", "dns.amazone.com"),
+        ]
+
+        # The authoritative server answers several questions the same way
+        client = LoopbackConnection(network)
+        client.send_message("2,0000,2,0,shop.amazone.com,8,shop.amazone.com,4", AUTHORITATIVE_ADDRESS)
+        response = Message(receive(client))
+        client.close()
+        assert [(answer["type"], answer["result"]) for answer in response.answers] == [
+            ("A", "3.33.147.88"),
+            ("A", "3.33.147.89"),
+            ("AAAA", "Record not found"),
+        ]
+
+
+def test_concurrent_misses_share_one_upstream_query():
+    network = LoopbackNetwork()
+    # Stands in for the authoritative server so the upstream queries can be counted
+    authoritative = LoopbackConnection(network, timeout=0.05)
+    authoritative.bind(AUTHORITATIVE_ADDRESS)
+    cache = local_table()
+
+    with running(local_server(network, cache)):
+        assert Message(receive(authoritative)).flag == "0010"
+        clients = [LoopbackConnection(network) for _ in range(3)]
+        for transaction_id, client in enumerate(clients):
+            query = {"transaction_id": transaction_id, "flag": "0000", "questions": [{"name": "a.com", "type": "A"}]}
+            client.send_message(localserver.serialize(query), LOCAL_ADDRESS)
+
+        # All three queries reach the local server before the answer does
+        upstream_query = Message(receive(authoritative))
+        assert upstream_query.flag == "0000"
+        response = {
+            "transaction_id": upstream_query.transaction_id,
+            "flag": "0001",
+            "questions": [{"name": "a.com", "type": "A"}],
+            "answers": [{"name": "a.com", "type": "A", "ttl": 60, "result": "1.1.1.1"}]
+        }
+        authoritative.send_message(localserver.serialize(response), LOCAL_ADDRESS)
+
+        for transaction_id, client in enumerate(clients):
+            answer = Message(receive(client))
+            assert answer.transaction_id == transaction_id
+            assert [answer["result"] for answer in answer.answers] == ["1.1.1.1"]
+            client.close()
+        assert received_flags(authoritative) == []
+        assert [record["result"] for record in cache.records] == ["1.1.1.1"]
+
+    authoritative.close()
+
+
+def test_unanswered_upstream_query_times_out():
+    network = LoopbackNetwork()
+    # Receives the upstream query and never answers it
+    authoritative = LoopbackConnection(network, timeout=0.05)
+    authoritative.bind(AUTHORITATIVE_ADDRESS)
+    cache = local_table()
+    clock = SimulatedClock()
+
+    with running(local_server(network, cache, clock=clock, upstream_timeout=2)):
+        client = LoopbackConnection(network)
+        client.send_message("1,0000,1,0,a.com,8", LOCAL_ADDRESS)
+        assert [Message(receive(authoritative)).flag for _ in range(2)] == ["0010", "0000"]
+
+        clock.advance(2)
+        response = Message(receive(client))
+        client.close()
+        assert [answer["result"] for answer in response.answers] == ["Server busy"]
+        assert cache.records == []
+
+    authoritative.close()
+
+
+@pytest.mark.parametrize("limit", [{"max_pending": 1}, {"max_waiting": 1}])
+def test_over_the_upstream_limits_answers_from_the_cache(limit):
+    network = LoopbackNetwork()
+    # Sends a snapshot and never answers a query, so the first miss stays in flight
+    authoritative = LoopbackConnection(network, timeout=0.05)
+    authoritative.bind(AUTHORITATIVE_ADDRESS)
+    cache = local_table()
+
+    with running(local_server(network, cache, **limit)):
+        assert Message(receive(authoritative)).flag == "0010"
+        send_transfer(authoritative, "0010", 0, [{"name": "shop.amazone.com", "type": "A", "ttl": 60, "result": "3.33.147.88"}])
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+
+        waiting_client = LoopbackConnection(network)
+        waiting_client.send_message("1,0000,1,0,a.com,8", LOCAL_ADDRESS)
+        assert Message(receive(authoritative)).flag == "0000"
+
+        # Another miss while that one is in flight is shed, what is cached is still answered
+        response = resolve_questions(network, [("shop.amazone.com", "A"), ("b.com", "A")], transaction_id=2)
+        assert [(answer["name"], answer["result"]) for answer in response.answers] == [
+            ("shop.amazone.com", "3.33.147.88"),
+            ("b.com", "Server busy"),
+        ]
+        assert received_flags(authoritative) == []
+        waiting_client.close()
+
+    authoritative.close()
+
+
+def test_malformed_datagram_does_not_stop_the_server():
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.88", 60, 1)
+    cache = local_table()
+
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache)):
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+        client = LoopbackConnection(network)
+        for garbage in ("garbage", "1,0000,5,0,a.com", "1,0000,1,0,a.com,A"):
+            client.send_message(garbage, LOCAL_ADDRESS)
+            client.send_message(garbage, AUTHORITATIVE_ADDRESS)
+        client.close()
+        # Not even text, UDPConnection cannot decode it either
+        network.deliver(b"\xff\xfe", ("127.0.0.1", 5000), LOCAL_ADDRESS)
+        network.deliver(b"\xff\xfe", ("127.0.0.1", 5000), AUTHORITATIVE_ADDRESS)
+
+        assert [answer["result"] for answer in resolve(network, "shop.amazone.com").answers] == ["3.33.147.88"]
+
+
+# QueryLog
+
+def log_queries(query_log, count):
+    for transaction_id in range(count):
+        query = Message(f"{transaction_id},0000,1,0,shop.amazone.com,8")
+        query_log.record(("127.0.0.1", 5000), query, [], 0.001)
+
+
+def readable_lines(path):
+    # Lines of a log that is still being written, up to its last flush
+    lines = 0
+    with gzip.open(path, "rt") as log_file:
+        try:
+            for _ in log_file:
+                lines += 1
+        except EOFError:
+            pass
+    return lines
+
+
+def replayed_queries(network, path):
+    return len(localserver.replay_query_log(path, speed=0, connection_factory=lambda: LoopbackConnection(network, timeout=0.2)))
+
+
+def test_replay_reads_a_log_that_is_still_written(tmp_path):
+    path = str(tmp_path / "queries.log.gz")
+    query_log = localserver.QueryLog(path, flush_interval=0.05)
+    network = LoopbackNetwork()
+    authoritative_table = amazone.RRTable()
+    authoritative_table.add_record("shop.amazone.com", "A", "3.33.147.88", 60, 1)
+    cache = local_table()
+
+    with running(authoritative_server(network, authoritative_table), local_server(network, cache)):
+        wait_for(lambda: cache.lookup("shop.amazone.com", 8))
+        log_queries(query_log, 20)
+        wait_for(lambda: readable_lines(path) == 20)
+        assert replayed_queries(network, path) == 20
+
+        # A server killed while writing leaves a gzip member cut off part way
+        with open(path, "rb") as log_file:
+            data = log_file.read()
+        killed_path = str(tmp_path / "killed.log.gz")
+        with open(killed_path, "wb") as log_file:
+            log_file.write(data[:-3])
+        assert replayed_queries(network, killed_path) == 20
+
+    query_log.close()
+
+
+def test_query_log_rotation(tmp_path):
+    path = str(tmp_path / "queries.log.gz")
+    query_log = localserver.QueryLog(path, max_bytes=100, backup_count=1)
+    log_queries(query_log, 1)
+    query_log.close()
+
+    # A log already there is rotated away, so max_bytes counts from an empty file
+    query_log = localserver.QueryLog(path, max_bytes=10 ** 6, backup_count=1)
+    log_queries(query_log, 2)
+    query_log.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["queries.log.gz", "queries.log.gz.1"]
+    with gzip.open(path, "rt") as log_file:
+        assert len(log_file.readlines()) == 2
+
+    # backup_count 0 keeps no old files at all: the full file is removed, path.1 is left alone
+    query_log = localserver.QueryLog(path, max_bytes=100, backup_count=0)
+    log_queries(query_log, 5)
+    query_log.close()
+    assert not os.path.exists(path + ".2")
+    with gzip.open(path + ".1", "rt") as log_file:
+        assert len(log_file.readlines()) == 1
+    with gzip.open(path, "rt") as log_file:
+        assert log_file.readlines() == []
+
+
+def test_query_log_with_a_bad_path_fails_right_away(tmp_path):
+    with pytest.raises(OSError):
+        localserver.QueryLog(str(tmp_path / "missing" / "queries.log.gz"))
+
+
+class FullDisk:
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        pass
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_query_log_closes_after_its_writer_died(tmp_path):
+    query_log = localserver.QueryLog(str(tmp_path / "queries.log.gz"), max_queue=2, flush_interval=0.01)
+    query_log.log_file.close()
+    query_log.log_file = FullDisk()
+    log_queries(query_log, 1)
+    query_log.thread.join(timeout=5)
+    assert not query_log.thread.is_alive()
+
+    # The queue fills up and drops entries, closing must still return
+    log_queries(query_log, 5)
+    assert query_log.dropped == 3
+    query_log.close()